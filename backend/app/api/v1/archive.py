@@ -0,0 +1,62 @@
+from fastapi import APIRouter, HTTPException, Query
+import logging
+from typing import Optional
+from app.core.config import settings
+from app.schemas.common import ArchivePoint, ArchiveQueryResult, AwaBin, AwaBinsResult
+from app.services import archive as A
+from app.services import parsing as P
+
+router = APIRouter(tags=["archive"])
+log = logging.getLogger("xboat-api")
+
+# Plain `def` handlers: Parquet scans block, so FastAPI runs them in its threadpool.
+
+@router.get("/archive/points", response_model=ArchiveQueryResult)
+def archive_points(athlete: Optional[str] = None, start: Optional[str] = None, end: Optional[str] = None,
+                   min_lat: Optional[float] = None, min_lon: Optional[float] = None,
+                   max_lat: Optional[float] = None, max_lon: Optional[float] = None,
+                   awa_min: Optional[float] = None, awa_max: Optional[float] = None,
+                   abs_awa_min: Optional[float] = None, abs_awa_max: Optional[float] = None,
+                   limit: int = Query(1000, gt=0, le=50_000)):
+    filters = _filters(athlete, start, end, min_lat, min_lon, max_lat, max_lon, awa_min, awa_max, abs_awa_min, abs_awa_max)
+    table = A.query(settings.ARCHIVE_ROOT, limit=limit + 1, **filters)
+    rows = table.to_pylist()
+    truncated = len(rows) > limit
+    rows = rows[:limit]
+    for r in rows:
+        r["timestamp"] = r["timestamp"].isoformat() if r["timestamp"] else None
+    return ArchiveQueryResult(count=len(rows), truncated=truncated, points=[ArchivePoint(**r) for r in rows])
+
+@router.get("/archive/awa-bins", response_model=AwaBinsResult)
+def archive_awa_bins(athlete: Optional[str] = None, start: Optional[str] = None, end: Optional[str] = None,
+                     min_lat: Optional[float] = None, min_lon: Optional[float] = None,
+                     max_lat: Optional[float] = None, max_lon: Optional[float] = None,
+                     abs_awa_min: Optional[float] = None, abs_awa_max: Optional[float] = None,
+                     bin_deg: float = 15.0):
+    # bins are by |AWA|, so only the |AWA| range is offered here (a signed range would drop one tack)
+    if not 0 < bin_deg <= 180:
+        raise HTTPException(status_code=400, detail="bin_deg must be in (0, 180].")
+    filters = _filters(athlete, start, end, min_lat, min_lon, max_lat, max_lon, None, None, abs_awa_min, abs_awa_max)
+    cols = ["session_id", "awa_deg", "speed_m_s", "apparent_wind_speed_ms", "wind_speed_10m_ms"]
+    try:
+        result = A.awa_bins(A.scan(settings.ARCHIVE_ROOT, columns=cols, **filters),
+                            bin_deg=bin_deg, max_rows=settings.ARCHIVE_AGG_MAX_ROWS)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    log.info(f"[archive] awa-bins over {result['count']} rows / {result['sessions']} sessions")
+    return AwaBinsResult(sessions=result["sessions"], count=result["count"], bins=[AwaBin(**b) for b in result["bins"]])
+
+def _filters(athlete, start, end, min_lat, min_lon, max_lat, max_lon, awa_min, awa_max, abs_awa_min, abs_awa_max) -> dict:
+    start_dt = P.to_dt(start) if start else None
+    end_dt = P.to_dt(end) if end else None
+    if (start and start_dt is None) or (end and end_dt is None):
+        raise HTTPException(status_code=400, detail="start/end must be ISO-8601 timestamps.")
+    box = (min_lat, min_lon, max_lat, max_lon)
+    if any(v is not None for v in box) and any(v is None for v in box):
+        raise HTTPException(status_code=400, detail="Bounding box needs min_lat, min_lon, max_lat and max_lon.")
+    return {
+        "athlete": athlete, "start": start_dt, "end": end_dt,
+        "bbox": box if box[0] is not None else None,
+        "awa_min": awa_min, "awa_max": awa_max,
+        "abs_awa_min": abs_awa_min, "abs_awa_max": abs_awa_max,
+    }
@@ -3,6 +3,7 @@ import logging
 from app.schemas.common import WindForTrackRequest, WindForTrackResult, WindedPoint
 from app.services.wind import fetch_openmeteo_hourly_auto, map_wind
 from app.services import parsing as P
+from app.services.admission import openmeteo
 
 router = APIRouter(tags=["wind"])
 log = logging.getLogger("xboat-api")
@@ -28,6 +29,11 @@ async def wind_for_track(req: WindForTrackRequest, return_full: bool = False):
         points=[WindedPoint(**p) for p in mapped] if return_full else None
     )
 
+@router.get("/wind/upstream-status")
+def upstream_status():
+    # shared breaker/token state plus queue and counter totals over all live workers
+    return openmeteo.snapshot()
+
 def _window(points):
     dts = [P.to_dt(p.timestamp) for p in points if p.timestamp]
     dts = [d for d in dts if d is not None]
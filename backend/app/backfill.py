@@ -0,0 +1,153 @@
+"""Bulk backfill of GPX/TCX/FIT sessions into the season archive.
+
+    python -m app.backfill ~/season/athlete_a ~/season/athlete_b --workers 8
+    python -m app.backfill ~/exports --athlete jdoe --root /data/archive
+
+Without --athlete, the first directory level under each input dir names the athlete
+(so <input>/<athlete>/...); files directly in the input dir use the input dir's name.
+"""
+import os, sys, time, random, asyncio, logging, argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Optional, Tuple
+
+from app.core.config import settings
+from app.services import parsing as P
+from app.services import archive as A
+from app.services.admission import openmeteo, UpstreamUnavailable
+from app.services.apparent import apparent_from_true, track_window, representative_coord
+from app.services.wind import fetch_openmeteo_hourly_auto, map_wind
+
+log = logging.getLogger("xboat-api")
+EXTS = (".gpx", ".tcx", ".fit")
+PARSERS = {"gpx": P.parse_gpx, "tcx": P.parse_tcx, "fit": P.parse_fit}
+MAX_BACKOFF_S = 30.0
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def _init_worker(rate_per_s: float = 0.0):
+    # one loop per process so the admission-control semaphore stays bound to a single loop
+    global _loop
+    _loop = asyncio.new_event_loop()
+    # all workers draw from one "backfill" bucket on top of the shared one, leaving headroom for the API
+    openmeteo.limit_share(rate_per_s, "openmeteo-backfill")
+
+def _fetch_wind(lat: float, lon: float, start_dt, end_dt, source: str, retry_s: float):
+    """fetch_openmeteo_hourly_auto, retried with jittered backoff for up to retry_s while
+    admission control refuses (breaker open, rate budget spent) instead of failing the file."""
+    give_up = time.monotonic() + retry_s
+    delay = 1.0
+    while True:
+        fetch = fetch_openmeteo_hourly_auto(lat, lon, start_dt, end_dt, source)
+        try:
+            # pool workers reuse their loop; a direct call gets a fresh one that is closed afterwards
+            return _loop.run_until_complete(fetch) if _loop else asyncio.run(fetch)
+        except UpstreamUnavailable as e:
+            wait = delay * random.uniform(0.5, 1.0)
+            if time.monotonic() + wait > give_up: raise
+            log.warning(f"[backfill] Open-Meteo unavailable ({e}); retrying in {wait:.1f}s")
+            time.sleep(wait)
+            delay = min(delay * 2, MAX_BACKOFF_S)
+
+def discover(inputs: List[str], athlete: Optional[str]) -> List[Tuple[str, str]]:
+    jobs = []
+    for inp in inputs:
+        base = Path(inp).expanduser().resolve()
+        for dirpath, _, files in os.walk(base):
+            for name in sorted(files):
+                if not name.lower().endswith(EXTS): continue
+                path = Path(dirpath) / name
+                rel = path.relative_to(base).parts
+                who = athlete or (rel[0] if len(rel) > 1 else base.name)
+                jobs.append((str(path), who))
+    return jobs
+
+def process_file(path: str, athlete: str, root: str, source: str, coord_strategy: str,
+                 min_speed_ms: float, overwrite: bool, retry_s: float = 0.0) -> Tuple[str, int]:
+    data = Path(path).read_bytes()
+    session_id = A.session_id_for(path, data)
+    if not overwrite and A.session_exists(root, athlete, session_id):
+        return ("skipped", 0)
+
+    file_type = P.detect_file_type(path, data[:4096])
+    if file_type not in PARSERS:
+        raise ValueError(f"Could not detect file type for {path}")
+    points = PARSERS[file_type](data)
+    P.derive_speeds(points)
+
+    start_dt, end_dt = track_window(points)
+    # the same activity exported as GPX and TCX must not be counted twice
+    other = A.claim_session(root, athlete, session_id, start_dt, end_dt, overwrite=overwrite)
+    if other:
+        log.warning(f"[backfill] {path} overlaps archived session {other} for {athlete}; skipping")
+        return ("duplicate", 0)
+
+    try:
+        lat, lon = representative_coord(points, strategy=coord_strategy)
+        source_used, times, u, v = _fetch_wind(lat, lon, start_dt, end_dt, source, retry_s)
+        rows = apparent_from_true(map_wind(points, times, u, v), min_speed_ms=min_speed_ms)
+
+        table = A.to_table(rows, session_id, source_used)
+        A.write_session(root, athlete, session_id, table, replace_overlapping=overwrite)
+    except BaseException:
+        A.release_claim(root, athlete, session_id)
+        raise
+    return ("ok", table.num_rows)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m app.backfill", description="Backfill sessions into the Parquet archive.")
+    ap.add_argument("inputs", nargs="*", help="directories to scan recursively for .gpx/.tcx/.fit")
+    ap.add_argument("--root", default=settings.ARCHIVE_ROOT, help="archive root (default: ARCHIVE_ROOT)")
+    ap.add_argument("--athlete", default=None, help="athlete id for every file (default: first subdirectory name)")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--source", default="auto", choices=["auto", "era5", "forecast"])
+    ap.add_argument("--coord-strategy", default="centroid", choices=["centroid", "start", "midpoint"])
+    ap.add_argument("--min-speed-ms", type=float, default=0.5)
+    ap.add_argument("--overwrite", action="store_true", help="rewrite sessions already in the archive")
+    ap.add_argument("--rate", type=float, default=settings.OPENMETEO_RATE_PER_S / 2,
+                    help="Open-Meteo requests/s for the whole backfill, within OPENMETEO_RATE_PER_S (default: half)")
+    ap.add_argument("--retry-s", type=float, default=2 * settings.OPENMETEO_BREAKER_RESET_S,
+                    help="keep retrying a file this long while Open-Meteo is unavailable; at least OPENMETEO_BREAKER_RESET_S (default: 2x that)")
+    ap.add_argument("--reindex", action="store_true", help="rebuild the session index from the Parquet files")
+    args = ap.parse_args(argv)
+    if not args.inputs and not args.reindex:
+        ap.error("give at least one input directory, or --reindex")
+
+    logging.basicConfig(
+        level=getattr(logging, settings.LOG_LEVEL.upper(), logging.INFO),
+        format="%(asctime)s | %(levelname)s | %(message)s",
+    )
+    if args.reindex:
+        n = A.rebuild_index(args.root)
+        log.info(f"[backfill] indexed {n} session file(s) under {args.root}")
+        if not args.inputs: return 0
+
+    jobs = discover(args.inputs, args.athlete)
+    log.info(f"[backfill] {len(jobs)} file(s) -> {args.root} with {args.workers} worker(s)")
+
+    counts = {"ok": 0, "skipped": 0, "duplicate": 0, "failed": 0}
+    rows_total = 0
+    with ProcessPoolExecutor(max_workers=max(1, args.workers), initializer=_init_worker, initargs=(args.rate,)) as pool:
+        futures = {
+            pool.submit(process_file, path, who, args.root, args.source, args.coord_strategy,
+                        args.min_speed_ms, args.overwrite, max(args.retry_s, settings.OPENMETEO_BREAKER_RESET_S)): path
+            for path, who in jobs
+        }
+        for fut in as_completed(futures):
+            path = futures[fut]
+            try:
+                status, n = fut.result()
+            except Exception as e:
+                counts["failed"] += 1
+                log.warning(f"[backfill] FAILED {path}: {e}")
+                continue
+            counts[status] += 1
+            rows_total += n
+            log.info(f"[backfill] {status} {path} ({n} rows)")
+
+    log.info(f"[backfill] done: {counts['ok']} written, {counts['skipped']} skipped, "
+             f"{counts['duplicate']} duplicate, {counts['failed']} failed, {rows_total} rows")
+    return 1 if counts["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
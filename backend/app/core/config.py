@@ -6,6 +6,17 @@ class Settings(BaseSettings):
     LOG_LEVEL: str = "INFO"
     CORS_ORIGINS: List[str] = ["*"]
     OPENMETEO_TIMEOUT_S: int = 30
+    # admission control (shared across gunicorn workers via a local SQLite file)
+    OPENMETEO_STATE_PATH: str = ""            # "" -> <tmpdir>/xboat-openmeteo.sqlite
+    OPENMETEO_RATE_PER_S: float = 5.0         # token refill rate for all workers combined; 0 disables
+    OPENMETEO_BURST: int = 10
+    OPENMETEO_MAX_INFLIGHT: int = 4           # concurrent upstream calls per worker
+    OPENMETEO_ACQUIRE_TIMEOUT_S: float = 10.0 # max wait for a slot/token before failing fast
+    OPENMETEO_BREAKER_FAILURES: int = 3
+    OPENMETEO_BREAKER_RESET_S: float = 30.0
+    OPENMETEO_STALE_CACHE_SIZE: int = 256
+    ARCHIVE_ROOT: str = "/data/archive"       # Parquet season archive (athlete=/date= partitions); a volume in compose
+    ARCHIVE_AGG_MAX_ROWS: int = 20_000_000   # awa-bins answers 400 past this many matching samples
 
     class Config:
         env_file = ".env"
@@ -9,6 +9,7 @@ from app.core.config import settings
 from app.api.v1.gps import router as gps_router
 from app.api.v1.wind import router as wind_router
 from app.api.v1.apparent import router as apparent_router
+from app.api.v1.archive import router as archive_router
 
 logging.basicConfig(
     level=getattr(logging, settings.LOG_LEVEL.upper(), logging.INFO),
@@ -35,6 +36,7 @@ app.add_middleware(
 app.include_router(gps_router, prefix="/api/v1")
 app.include_router(wind_router, prefix="/api/v1")
 app.include_router(apparent_router, prefix="/api/v1")
+app.include_router(archive_router, prefix="/api/v1")
 
 # --- resolve <repo>/backend/sample_data as an absolute path ---
 HERE = Path(__file__).resolve().parent         # backend/app
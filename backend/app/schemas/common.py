@@ -68,3 +68,29 @@ class ApparentWindResult(BaseModel):
     mapped_count: int
     sample: List[ApparentPoint]
     points: Optional[List[ApparentPoint]] = None
+
+# --- Season archive query models ---
+
+class ArchivePoint(ApparentPoint):
+    athlete: Optional[str] = None
+    session_id: Optional[str] = None
+    source: Optional[str] = None    # wind source used at backfill time
+
+class ArchiveQueryResult(BaseModel):
+    count: int
+    truncated: bool                 # True when more rows matched than `limit`
+    points: List[ArchivePoint]
+
+class AwaBin(BaseModel):
+    awa_lo_deg: float               # |AWA| bin, 0 = head, 180 = tail
+    awa_hi_deg: float
+    count: int
+    mean_speed_m_s: Optional[float] = None
+    mean_apparent_wind_speed_ms: Optional[float] = None
+    mean_wind_speed_10m_ms: Optional[float] = None
+    speed_delta_m_s: Optional[float] = None   # bin mean boat speed minus overall mean
+
+class AwaBinsResult(BaseModel):
+    sessions: int
+    count: int
+    bins: List[AwaBin]
@@ -0,0 +1,380 @@
+import os, json, time, asyncio, sqlite3, logging, tempfile
+from contextlib import closing, contextmanager
+from typing import Awaitable, Callable, Dict, Optional
+import httpx
+from cachetools import LRUCache
+from app.core.config import settings
+
+log = logging.getLogger("xboat-api")
+PUBLISH_INTERVAL_S = 1.0   # worker stats -> SharedState, for the aggregated status endpoint
+
+class UpstreamUnavailable(RuntimeError):
+    """Raised when a call is refused by admission control and no stale copy exists."""
+
+class SharedState:
+    """One SQLite file holding everything gunicorn workers must agree on: tokens, breakers, worker stats.
+
+    Times stored here are wall-clock (time.time()) because monotonic clocks aren't comparable across processes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._ready_pid: Optional[int] = None
+
+    def connect(self):
+        # schema + WAL once per process; redone if a tmp cleaner removed the file
+        fresh = self._ready_pid != os.getpid() or not os.path.exists(self.path)
+        conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+        if fresh:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS bucket (name TEXT PRIMARY KEY, tokens REAL, updated REAL);
+                CREATE TABLE IF NOT EXISTS breaker (tag TEXT PRIMARY KEY, state TEXT, failures INTEGER,
+                                                    opened_at REAL, probe_until REAL);
+                CREATE TABLE IF NOT EXISTS worker (pid INTEGER PRIMARY KEY, stats TEXT, updated REAL);
+            """)
+            self._ready_pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def txn(self):
+        with closing(self.connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+class SharedTokenBucket:
+    """Token bucket persisted in SQLite so every gunicorn worker draws from the same budget."""
+
+    def __init__(self, state: SharedState, rate_per_s: float, burst: int, name: str = "openmeteo"):
+        self.state, self.rate, self.burst, self.name = state, rate_per_s, max(1, burst), name
+
+    def _try_take(self) -> float:
+        """Take one token; returns 0.0 on success, else seconds until a token is due."""
+        with self.state.txn() as conn:
+            now = time.time()
+            row = conn.execute("SELECT tokens, updated FROM bucket WHERE name=?", (self.name,)).fetchone()
+            tokens = float(self.burst) if row is None else min(self.burst, row[0] + max(0.0, now - row[1]) * self.rate)
+            wait = 0.0
+            if tokens >= 1.0:
+                tokens -= 1.0
+            else:
+                wait = (1.0 - tokens) / self.rate
+            conn.execute("INSERT OR REPLACE INTO bucket (name, tokens, updated) VALUES (?, ?, ?)", (self.name, tokens, now))
+        return wait
+
+    def level(self) -> Optional[float]:
+        try:
+            with closing(self.state.connect()) as conn:
+                row = conn.execute("SELECT tokens, updated FROM bucket WHERE name=?", (self.name,)).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None: return float(self.burst)
+        return min(self.burst, row[0] + max(0.0, time.time() - row[1]) * self.rate)
+
+    async def acquire(self, timeout_s: float) -> bool:
+        if self.rate <= 0: return True
+        deadline = time.monotonic() + timeout_s
+        while True:
+            wait = await asyncio.to_thread(self._try_take)
+            if wait <= 0: return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: return False
+            await asyncio.sleep(min(wait, remaining))
+
+class CircuitBreaker:
+    """closed -> open after N consecutive failures; open -> half_open after reset_s; one probe decides.
+
+    State lives in SharedState, so a failure seen by any worker counts for all of them and one
+    worker's probe decides for everyone. The probe slot is a lease (probe_until) so a worker that
+    dies mid-probe can't wedge the breaker in half_open.
+    """
+
+    def __init__(self, state: SharedState, tag: str, failure_threshold: int, reset_s: float, probe_lease_s: float):
+        self.state, self.tag = state, tag
+        self.failure_threshold, self.reset_s = max(1, failure_threshold), reset_s
+        self.probe_lease_s = probe_lease_s
+
+    def _load(self, conn):
+        row = conn.execute("SELECT state, failures, opened_at, probe_until FROM breaker WHERE tag=?", (self.tag,)).fetchone()
+        return row or ("closed", 0, 0.0, 0.0)
+
+    def _save(self, conn, state, failures, opened_at, probe_until):
+        conn.execute("INSERT OR REPLACE INTO breaker (tag, state, failures, opened_at, probe_until) VALUES (?, ?, ?, ?, ?)",
+                     (self.tag, state, failures, opened_at, probe_until))
+
+    def allow(self) -> bool:
+        with self.state.txn() as conn:
+            state, failures, opened_at, probe_until = self._load(conn)
+            now = time.time()
+            if state == "open" and now - opened_at >= self.reset_s:
+                state, probe_until = "half_open", 0.0
+            allowed = state == "closed"
+            if state == "half_open" and probe_until <= now:
+                probe_until, allowed = now + self.probe_lease_s, True
+            self._save(conn, state, failures, opened_at, probe_until)
+        return allowed
+
+    def release(self):
+        """Give back a half-open probe slot when the call never reached the upstream."""
+        with self.state.txn() as conn:
+            conn.execute("UPDATE breaker SET probe_until=0 WHERE tag=?", (self.tag,))
+
+    def record_success(self):
+        with self.state.txn() as conn:
+            self._save(conn, "closed", 0, 0.0, 0.0)
+
+    def record_failure(self):
+        with self.state.txn() as conn:
+            state, failures, opened_at, _ = self._load(conn)
+            failures += 1
+            if state == "half_open" or failures >= self.failure_threshold:
+                if state != "open":
+                    log.warning(f"[admission] {self.tag} circuit open after {failures} failure(s)")
+                state, opened_at = "open", time.time()
+            self._save(conn, state, failures, opened_at, 0.0)
+
+    def snapshot(self) -> dict:
+        with closing(self.state.connect()) as conn:
+            state, failures, opened_at, _ = self._load(conn)
+        retry_in = max(0.0, self.reset_s - (time.time() - opened_at)) if state == "open" else 0.0
+        return {"state": state, "consecutive_failures": failures, "retry_in_s": round(retry_in, 1)}
+
+def _is_upstream_fault(e: Exception) -> bool:
+    # 4xx (other than 429) means the upstream answered sanely to a bad request; don't trip on it
+    if isinstance(e, httpx.HTTPStatusError):
+        code = e.response.status_code
+        return code == 429 or code >= 500
+    return True
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class AdmissionControl:
+    """Rate limit, bound concurrency and circuit-break calls to one upstream, serving stale data when refused.
+
+    Tokens and breaker state are shared by all workers through SharedState; the in-flight cap and
+    the stale cache are per worker. If the state file is unusable the layer fails open (counted
+    as limiter_errors) rather than blocking or tripping on a local fault.
+    """
+
+    def __init__(self, *, state_path: str, rate_per_s: float, burst: int, max_inflight: int,
+                 acquire_timeout_s: float, upstream_timeout_s: float, failure_threshold: int,
+                 reset_s: float, stale_size: int):
+        self.state = SharedState(state_path)
+        self.bucket = SharedTokenBucket(self.state, rate_per_s, burst)
+        self.share: Optional[SharedTokenBucket] = None   # see limit_share()
+        self.max_inflight = max(1, max_inflight)
+        self.acquire_timeout_s, self.upstream_timeout_s = acquire_timeout_s, upstream_timeout_s
+        self._failure_threshold, self._reset_s = failure_threshold, reset_s
+        # a call never outlives its deadline (<= upstream_timeout_s), so neither does its probe
+        self._probe_lease_s = upstream_timeout_s + 1.0
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.stale: LRUCache = LRUCache(maxsize=max(1, stale_size))
+        self._sem: Optional[asyncio.Semaphore] = None
+        self.waiting = 0            # calls without both a slot and a token yet
+        self.waiting_for_token = 0  # of those, the ones holding a slot and sleeping on the bucket
+        self.inflight = 0
+        self._published_at = 0.0
+        self.counters = {"admitted": 0, "rejected_open": 0, "rejected_queue": 0, "rejected_rate": 0,
+                         "limiter_errors": 0, "upstream_errors": 0, "stale_served": 0}
+
+    def breaker(self, tag: str) -> CircuitBreaker:
+        if tag not in self.breakers:
+            self.breakers[tag] = CircuitBreaker(self.state, tag, self._failure_threshold, self._reset_s, self._probe_lease_s)
+        return self.breakers[tag]
+
+    def limit_share(self, rate_per_s: float, name: str):
+        """Also draw every call of this process from a bucket of its own, so e.g. a backfill takes
+        at most rate_per_s of the shared budget and leaves the rest to the API."""
+        self.share = SharedTokenBucket(self.state, rate_per_s, 1, name=name) if rate_per_s > 0 else None
+
+    async def _take_tokens(self, timeout_s: float) -> bool:
+        until = time.monotonic() + timeout_s
+        for bucket in (self.share, self.bucket):
+            if bucket is not None and not await bucket.acquire(max(0.0, until - time.monotonic())):
+                return False
+        return True
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.max_inflight)
+        return self._sem
+
+    async def _shared(self, fn, default=None):
+        """Run a SharedState operation off the event loop (it may wait on the SQLite lock);
+        local SQLite trouble is logged and never reaches the caller."""
+        try:
+            return await asyncio.to_thread(fn)
+        except sqlite3.Error as e:
+            self.counters["limiter_errors"] += 1
+            log.warning(f"[admission] shared state unavailable ({e}); failing open")
+            return default
+
+    def _stats(self) -> dict:
+        return {"queue_depth": self.waiting, "waiting_for_token": self.waiting_for_token, "inflight": self.inflight,
+                "stale_entries": len(self.stale), **self.counters}
+
+    def _publish(self, stats: Optional[dict] = None):
+        try:
+            with self.state.txn() as conn:
+                conn.execute("INSERT OR REPLACE INTO worker (pid, stats, updated) VALUES (?, ?, ?)",
+                             (os.getpid(), json.dumps(stats or self._stats()), time.time()))
+        except sqlite3.Error as e:
+            log.debug(f"[admission] could not publish worker stats: {e}")
+
+    async def _maybe_publish(self):
+        # at most one stats write per PUBLISH_INTERVAL_S per worker, off the event loop; going
+        # idle is always written so the aggregate never shows a finished burst as still queued
+        now = time.monotonic()
+        idle = self.waiting == 0 and self.inflight == 0
+        if not idle and now - self._published_at < PUBLISH_INTERVAL_S: return
+        self._published_at = now
+        await asyncio.to_thread(self._publish, self._stats())
+
+    def _stale_or_raise(self, key, tag: str, reason: str, cause: Optional[Exception] = None):
+        if key in self.stale:
+            self.counters["stale_served"] += 1
+            log.warning(f"[{tag}] {reason}; serving stale response")
+            return self.stale[key]
+        raise UpstreamUnavailable(f"{tag}: {reason}") from cause
+
+    def deadline(self) -> float:
+        """Monotonic deadline for one logical request; pass it to every call() made on its behalf."""
+        return time.monotonic() + self.upstream_timeout_s
+
+    async def call(self, tag: str, url: str, params: dict, fetch: Callable[[str, dict, float], Awaitable[dict]],
+                   deadline: Optional[float] = None) -> dict:
+        """Admit and run fetch(url, params, timeout_s).
+
+        Waiting for a slot and a token together is bounded by acquire_timeout_s, and the whole call
+        (waits + upstream) by `deadline`, which defaults to upstream_timeout_s from now.
+        """
+        try:
+            return await self._call(tag, url, params, fetch, deadline or self.deadline())
+        finally:
+            await self._maybe_publish()
+
+    async def _call(self, tag: str, url: str, params: dict, fetch: Callable[[str, dict, float], Awaitable[dict]],
+                    deadline: float) -> dict:
+        key = (url, tuple(sorted(params.items())))
+        br = self.breaker(tag)
+        if not await self._shared(br.allow, default=True):
+            self.counters["rejected_open"] += 1
+            return self._stale_or_raise(key, tag, "circuit open")
+
+        # every exit that doesn't record a result (refusal, cancellation, ...) must hand back
+        # a half-open probe slot, or the breaker would sit in half_open until the lease expires
+        settled = False
+        admit_by = min(time.monotonic() + self.acquire_timeout_s, deadline)
+        # a call stays in queue_depth until it holds both a slot and a token
+        queued = True
+        self.waiting += 1
+        try:
+            sem = self._semaphore()
+            await self._maybe_publish()
+            try:
+                await asyncio.wait_for(sem.acquire(), timeout=max(0.0, admit_by - time.monotonic()))
+            except asyncio.TimeoutError:
+                self.counters["rejected_queue"] += 1
+                return self._stale_or_raise(key, tag, "no in-flight slot before the deadline")
+
+            try:
+                # the shared bucket is local state, not the upstream: keep its errors out of the breaker
+                self.waiting_for_token += 1
+                try:
+                    admitted = await self._take_tokens(max(0.0, admit_by - time.monotonic()))
+                except sqlite3.Error as e:
+                    # fail open: the per-worker slot cap and the breaker still bound the load
+                    self.counters["limiter_errors"] += 1
+                    log.warning(f"[admission] shared limiter unavailable ({e}); admitting without a token")
+                    admitted = True
+                finally:
+                    self.waiting_for_token -= 1
+                # a token granted at the last moment can leave no time for the call; that is a
+                # refusal like any other, not an upstream failure, so the breaker never sees it
+                remaining = deadline - time.monotonic()
+                if not admitted or remaining <= 0:
+                    self.counters["rejected_rate"] += 1
+                    return self._stale_or_raise(key, tag, "rate limit budget exhausted before the deadline")
+
+                queued = False
+                self.waiting -= 1
+                self.counters["admitted"] += 1
+                self.inflight += 1
+                try:
+                    data = await asyncio.wait_for(fetch(url, params, remaining), timeout=remaining)
+                except Exception as e:
+                    if not _is_upstream_fault(e):
+                        await self._shared(br.record_success); settled = True
+                        raise
+                    await self._shared(br.record_failure); settled = True
+                    self.counters["upstream_errors"] += 1
+                    return self._stale_or_raise(key, tag, f"upstream error ({str(e) or type(e).__name__})", e)
+                finally:
+                    self.inflight -= 1
+            finally:
+                sem.release()
+
+            await self._shared(br.record_success); settled = True
+            self.stale[key] = data
+            return data
+        finally:
+            if queued:
+                self.waiting -= 1
+            if not settled:
+                # the worker thread runs to completion even if this await is cancelled again
+                await self._shared(br.release)
+
+    def snapshot(self) -> dict:
+        """Status across all live workers: shared breakers and tokens, summed per-worker stats."""
+        self._publish()
+        local = {os.getpid(): self._stats()}
+        try:
+            with self.state.txn() as conn:
+                tags = [r[0] for r in conn.execute("SELECT tag FROM breaker ORDER BY tag")]
+                per_worker = {}
+                for pid, stats in conn.execute("SELECT pid, stats FROM worker").fetchall():
+                    if _pid_alive(pid):
+                        per_worker[pid] = json.loads(stats)
+                    else:
+                        conn.execute("DELETE FROM worker WHERE pid=?", (pid,))
+            breakers = {tag: self.breaker(tag).snapshot() for tag in tags}
+            shared = True
+        except sqlite3.Error as e:
+            log.warning(f"[admission] shared state unavailable ({e}); reporting this worker only")
+            per_worker, breakers, shared = local, {}, False
+        per_worker = per_worker or local
+        totals = {k: sum(w.get(k, 0) for w in per_worker.values()) for k in local[os.getpid()]}
+        level = self.bucket.level() if self.bucket.rate > 0 else None
+        return {
+            "shared_state": shared,
+            "workers": len(per_worker),
+            "breakers": breakers,
+            "tokens_available": None if level is None else round(level, 2),
+            "max_inflight_per_worker": self.max_inflight,
+            **totals,
+            "per_worker": {str(pid): w for pid, w in sorted(per_worker.items())},
+        }
+
+openmeteo = AdmissionControl(
+    state_path=settings.OPENMETEO_STATE_PATH or os.path.join(tempfile.gettempdir(), "xboat-openmeteo.sqlite"),
+    rate_per_s=settings.OPENMETEO_RATE_PER_S,
+    burst=settings.OPENMETEO_BURST,
+    max_inflight=settings.OPENMETEO_MAX_INFLIGHT,
+    acquire_timeout_s=settings.OPENMETEO_ACQUIRE_TIMEOUT_S,
+    upstream_timeout_s=settings.OPENMETEO_TIMEOUT_S,
+    failure_threshold=settings.OPENMETEO_BREAKER_FAILURES,
+    reset_s=settings.OPENMETEO_BREAKER_RESET_S,
+    stale_size=settings.OPENMETEO_STALE_CACHE_SIZE,
+)
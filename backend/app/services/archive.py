@@ -0,0 +1,350 @@
+import os, math, time, sqlite3, hashlib, logging, datetime
+from contextlib import closing
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from app.services import parsing as P
+
+log = logging.getLogger("xboat-api")
+
+# <root>/athlete=<id>/date=<YYYY-MM-DD>/<session_id>.parquet, plus <root>/_sessions.sqlite:
+# one row per session with its time range, bbox and AWA range, used to pick files before scanning
+INDEX_FILE = "_sessions.sqlite"
+# an athlete can't row two sessions at once: this much time overlap (of the shorter one) = same activity
+DUPLICATE_OVERLAP = 0.5
+AGG_CHUNK_ROWS = 1 << 20   # awa_bins folds this many rows per group_by
+CLAIM_TTL_S = 3600.0      # claims older than this are from a crashed backfill
+PARTITIONING = ds.partitioning(pa.schema([("athlete", pa.string()), ("date", pa.string())]), flavor="hive")
+TS_TYPE = pa.timestamp("us", tz="UTC")
+
+SCHEMA = pa.schema([
+    ("session_id", pa.string()),
+    ("source", pa.string()),              # wind source: era5 | forecast
+    ("timestamp", TS_TYPE),
+    ("lat", pa.float64()),
+    ("lon", pa.float64()),
+    ("altitude_m", pa.float64()),
+    ("speed_m_s", pa.float64()),
+    ("heart_rate_bpm", pa.int32()),
+    ("cadence_rpm", pa.int32()),
+    ("course_deg", pa.float64()),
+    ("wind_speed_10m_ms", pa.float64()),
+    ("wind_direction_10m_deg", pa.float64()),
+    ("apparent_wind_speed_ms", pa.float64()),
+    ("apparent_wind_dir_deg", pa.float64()),
+    ("awa_deg", pa.float64()),
+])
+# file schema + the partition columns the dataset derives from the path
+DATASET_SCHEMA = pa.unify_schemas([SCHEMA, PARTITIONING.schema])
+
+def session_id_for(path: str, data: bytes) -> str:
+    """Stable id from file name + content, so re-running a backfill is idempotent."""
+    h = hashlib.sha1(data).hexdigest()[:12]
+    return f"{Path(path).stem}-{h}"
+
+def _safe_part(value: str) -> str:
+    return "".join(c if c.isalnum() or c in "-_." else "_" for c in value) or "unknown"
+
+def session_path(root: str, athlete: str, date: str, session_id: str) -> Path:
+    return Path(root) / f"athlete={_safe_part(athlete)}" / f"date={date}" / f"{session_id}.parquet"
+
+def to_table(rows: List[dict], session_id: str, source: Optional[str]) -> pa.Table:
+    """Apparent-wind rows (as returned by apparent_from_true) -> Arrow table sorted by time."""
+    rows = [r for r in rows if P.to_dt(r.get("timestamp")) is not None]
+    rows.sort(key=lambda r: P.to_dt(r["timestamp"]))
+    cols = {name: [r.get(name) for r in rows] for name in SCHEMA.names if name not in ("session_id", "source", "timestamp")}
+    cols["timestamp"] = [P.to_dt(r["timestamp"]) for r in rows]
+    cols["session_id"] = [session_id] * len(rows)
+    cols["source"] = [source] * len(rows)
+    return pa.Table.from_pydict(cols, schema=SCHEMA)
+
+def _index(root: str):
+    Path(root).mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(Path(root) / INDEX_FILE), timeout=30.0, isolation_level=None)
+    # sessions: written files only; claims: sessions a backfill worker is writing right now
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            athlete TEXT, session_id TEXT, path TEXT, rows INTEGER,
+            t_min REAL, t_max REAL, lat_min REAL, lat_max REAL, lon_min REAL, lon_max REAL,
+            awa_min REAL, awa_max REAL, abs_awa_min REAL, abs_awa_max REAL,
+            PRIMARY KEY (athlete, session_id));
+        CREATE INDEX IF NOT EXISTS sessions_time ON sessions (athlete, t_min, t_max);
+        CREATE TABLE IF NOT EXISTS claims (
+            athlete TEXT, session_id TEXT, t_min REAL, t_max REAL, claimed_at REAL,
+            PRIMARY KEY (athlete, session_id));
+    """)
+    return conn
+
+def _summary(table: pa.Table) -> dict:
+    """Per-session ranges stored in the index (epoch seconds for time)."""
+    def mm(arr):
+        r = pc.min_max(arr).as_py()
+        return r["min"], r["max"]
+    t_min, t_max = mm(table["timestamp"])
+    lat_min, lat_max = mm(table["lat"])
+    lon_min, lon_max = mm(table["lon"])
+    awa_min, awa_max = mm(table["awa_deg"])
+    abs_min, abs_max = mm(pc.abs(table["awa_deg"]))
+    return {"rows": table.num_rows, "t_min": t_min.timestamp(), "t_max": t_max.timestamp(),
+            "lat_min": lat_min, "lat_max": lat_max, "lon_min": lon_min, "lon_max": lon_max,
+            "awa_min": awa_min, "awa_max": awa_max, "abs_awa_min": abs_min, "abs_awa_max": abs_max}
+
+def _index_session(conn, athlete: str, session_id: str, rel_path: str, summary: dict):
+    cols = ["athlete", "session_id", "path", *summary]
+    conn.execute(f"INSERT OR REPLACE INTO sessions ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})",
+                 (_safe_part(athlete), session_id, rel_path, *summary.values()))
+
+def _overlapping(conn, table: str, athlete: str, session_id: str, t_min: float, t_max: float) -> list:
+    """(session_id, t_min, t_max[, path]) rows of `table` (sessions or claims), other than
+    session_id itself, that cover the same activity."""
+    cols = "session_id, t_min, t_max, path" if table == "sessions" else "session_id, t_min, t_max"
+    rows = conn.execute(f"SELECT {cols} FROM {table} WHERE athlete = ? AND session_id <> ? AND t_min < ? AND t_max > ?",
+                        (_safe_part(athlete), session_id, t_max, t_min)).fetchall()
+    return [r for r in rows
+            if min(t_max, r[2]) - max(t_min, r[1]) >= DUPLICATE_OVERLAP * max(1.0, min(t_max - t_min, r[2] - r[1]))]
+
+def claim_session(root: str, athlete: str, session_id: str, start: datetime.datetime,
+                  end: datetime.datetime, overwrite: bool = False) -> Optional[str]:
+    """Reserve [start, end] for a session about to be written.
+
+    Returns the id of a stored (or in-flight) session of the same athlete that covers the same
+    activity, e.g. the GPX export of a TCX already archived; the caller should then skip. With
+    overwrite, stored duplicates don't block (write_session replaces them once the new file is
+    in place), while in-flight ones still win. The check-and-claim is one transaction, so
+    parallel workers can't both write the same activity. Stored sessions are never touched here.
+    """
+    t_min, t_max = start.timestamp(), end.timestamp()
+    with closing(_index(root)) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            conn.execute("DELETE FROM claims WHERE claimed_at <= ?", (now - CLAIM_TTL_S,))
+            mine = conn.execute("SELECT 1 FROM claims WHERE athlete = ? AND session_id = ?",
+                                (_safe_part(athlete), session_id)).fetchone()
+            blocking = [session_id] if mine else [r[0] for r in _overlapping(conn, "claims", athlete, session_id, t_min, t_max)]
+            if not blocking and not overwrite:
+                blocking = [r[0] for r in _overlapping(conn, "sessions", athlete, session_id, t_min, t_max)]
+            if blocking:
+                conn.execute("COMMIT")
+                return blocking[0]
+            conn.execute("INSERT INTO claims (athlete, session_id, t_min, t_max, claimed_at) VALUES (?, ?, ?, ?, ?)",
+                         (_safe_part(athlete), session_id, t_min, t_max, now))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    return None
+
+def release_claim(root: str, athlete: str, session_id: str):
+    """Drop a claim whose write failed; whatever was stored for the session before stays as it was."""
+    with closing(_index(root)) as conn:
+        conn.execute("DELETE FROM claims WHERE athlete = ? AND session_id = ?", (_safe_part(athlete), session_id))
+
+def write_session(root: str, athlete: str, session_id: str, table: pa.Table, replace_overlapping: bool = False) -> Path:
+    """Write one session file into its athlete/date partition (date of the first fix), index it and
+    drop its claim. With replace_overlapping, stored sessions covering the same activity are
+    removed, but only after the new file is written and indexed."""
+    if table.num_rows == 0:
+        raise ValueError("No timestamped points to archive.")
+    date = table.column("timestamp")[0].as_py().date().isoformat()
+    out = session_path(root, athlete, date, session_id)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    tmp = out.with_suffix(f".parquet.tmp{os.getpid()}")
+    pq.write_table(table, tmp, compression="zstd", row_group_size=16_384, write_statistics=True)
+    os.replace(tmp, out)
+    summary = _summary(table)
+    with closing(_index(root)) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            _index_session(conn, athlete, session_id, str(out.relative_to(root)), summary)
+            dups = _overlapping(conn, "sessions", athlete, session_id, summary["t_min"], summary["t_max"]) if replace_overlapping else []
+            for other_id, *_ in dups:
+                conn.execute("DELETE FROM sessions WHERE athlete = ? AND session_id = ?", (_safe_part(athlete), other_id))
+            conn.execute("DELETE FROM claims WHERE athlete = ? AND session_id = ?", (_safe_part(athlete), session_id))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    # files go only once the index no longer points at them
+    for other_id, _, _, path in dups:
+        log.warning(f"[archive] {session_id} replaces overlapping session {other_id}")
+        if path: Path(root, path).unlink(missing_ok=True)
+    return out
+
+def session_exists(root: str, athlete: str, session_id: str) -> bool:
+    base = Path(root) / f"athlete={_safe_part(athlete)}"
+    return base.is_dir() and any(base.glob(f"date=*/{session_id}.parquet"))
+
+def rebuild_index(root: str) -> int:
+    """Re-create the session index from the Parquet files (archives written before it existed)."""
+    files = _partition_files(root, None, None, None)
+    with closing(_index(root)) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM sessions")
+        for f in files:
+            rel = Path(f).relative_to(root)
+            athlete = rel.parts[0][len("athlete="):]
+            table = pq.read_table(f, columns=["timestamp", "lat", "lon", "awa_deg"])
+            _index_session(conn, athlete, Path(f).stem, str(rel), _summary(table))
+        conn.execute("COMMIT")
+        # sessions archived before de-duplication existed may double-count an activity
+        for athlete, a, b in conn.execute(
+                "SELECT x.athlete, x.session_id, y.session_id FROM sessions x JOIN sessions y "
+                "ON x.athlete = y.athlete AND x.session_id < y.session_id AND x.t_min < y.t_max AND x.t_max > y.t_min"):
+            log.warning(f"[archive] {athlete}: sessions {a} and {b} overlap in time (same activity?)")
+    return len(files)
+
+def _partition_files(root: str, athlete: Optional[str], start: Optional[datetime.datetime],
+                     end: Optional[datetime.datetime]) -> List[str]:
+    """Prune by directory name before the dataset ever lists/opens a file."""
+    base = Path(root)
+    if not base.is_dir(): return []
+    athlete_dirs = [base / f"athlete={_safe_part(athlete)}"] if athlete else sorted(base.glob("athlete=*"))
+    # sessions are partitioned by start date and may run past midnight, so look one day back
+    lo = (start.date() - datetime.timedelta(days=1)).isoformat() if start else None
+    hi = end.date().isoformat() if end else None
+    files = []
+    for adir in athlete_dirs:
+        if not adir.is_dir(): continue
+        for ddir in sorted(adir.glob("date=*")):
+            d = ddir.name[len("date="):]
+            if lo and d < lo: continue
+            if hi and d > hi: continue
+            files.extend(str(f) for f in sorted(ddir.glob("*.parquet")))
+    return files
+
+def _indexed_files(root: str, athlete, start, end, bbox, awa_min, awa_max,
+                   abs_awa_min=None, abs_awa_max=None) -> Optional[List[str]]:
+    """Files whose indexed ranges can satisfy the filter; None when the archive has no index."""
+    if not (Path(root) / INDEX_FILE).exists(): return None
+    where, args = [], []
+    def cond(sql, *vals):
+        where.append(sql); args.extend(vals)
+    if athlete:             cond("athlete = ?", _safe_part(athlete))
+    if start is not None:   cond("t_max >= ?", start.timestamp())
+    if end is not None:     cond("t_min <= ?", end.timestamp())
+    if bbox is not None:
+        min_lat, min_lon, max_lat, max_lon = bbox
+        cond("lat_max >= ? AND lat_min <= ? AND lon_max >= ? AND lon_min <= ?", min_lat, max_lat, min_lon, max_lon)
+    if awa_min is not None: cond("awa_max >= ?", awa_min)
+    if awa_max is not None: cond("awa_min <= ?", awa_max)
+    if abs_awa_min is not None: cond("abs_awa_max >= ?", abs_awa_min)
+    if abs_awa_max is not None: cond("abs_awa_min <= ?", abs_awa_max)
+    sql = "SELECT path FROM sessions" + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY path"
+    with closing(_index(root)) as conn:
+        return [str(Path(root) / r[0]) for r in conn.execute(sql, args)]
+
+def _filter_expr(start, end, bbox, awa_min, awa_max, abs_awa_min=None, abs_awa_max=None):
+    expr = None
+    def _and(e):
+        nonlocal expr
+        expr = e if expr is None else expr & e
+    if start is not None: _and(ds.field("timestamp") >= pa.scalar(start, type=TS_TYPE))
+    if end is not None:   _and(ds.field("timestamp") <= pa.scalar(end, type=TS_TYPE))
+    if bbox is not None:
+        min_lat, min_lon, max_lat, max_lon = bbox
+        _and((ds.field("lat") >= min_lat) & (ds.field("lat") <= max_lat)
+             & (ds.field("lon") >= min_lon) & (ds.field("lon") <= max_lon))
+    if awa_min is not None: _and(ds.field("awa_deg") >= awa_min)
+    if awa_max is not None: _and(ds.field("awa_deg") <= awa_max)
+    # |AWA| can't use Parquet stats on awa_deg, but the session index still prunes on it
+    if abs_awa_min is not None: _and(pc.abs(ds.field("awa_deg")) >= abs_awa_min)
+    if abs_awa_max is not None: _and(pc.abs(ds.field("awa_deg")) <= abs_awa_max)
+    return expr
+
+def _dataset(root: str, athlete=None, start=None, end=None, bbox=None, awa_min=None, awa_max=None,
+             abs_awa_min=None, abs_awa_max=None):
+    """(dataset over the candidate files, row filter); dataset is None when no file can match."""
+    files = _indexed_files(root, athlete, start, end, bbox, awa_min, awa_max, abs_awa_min, abs_awa_max)
+    if files is None:
+        files = _partition_files(root, athlete, start, end)
+    if not files: return None, None
+    dataset = ds.dataset(files, schema=DATASET_SCHEMA, format="parquet", partitioning=PARTITIONING, partition_base_dir=root)
+    return dataset, _filter_expr(start, end, bbox, awa_min, awa_max, abs_awa_min, abs_awa_max)
+
+def query(root: str, *, athlete: Optional[str] = None,
+          start: Optional[datetime.datetime] = None, end: Optional[datetime.datetime] = None,
+          bbox: Optional[Tuple[float, float, float, float]] = None,
+          awa_min: Optional[float] = None, awa_max: Optional[float] = None,
+          abs_awa_min: Optional[float] = None, abs_awa_max: Optional[float] = None,
+          columns: Optional[Iterable[str]] = None, limit: Optional[int] = None) -> pa.Table:
+    """Filtered scan of the archive. bbox is (min_lat, min_lon, max_lat, max_lon) like parsing.bounds();
+    awa_min/awa_max bound the signed awa_deg (+ = starboard), abs_awa_min/abs_awa_max bound |awa_deg|.
+
+    Sessions are first picked from the index by time range, bbox and AWA range, so files that
+    can't match are never opened; the filter is then pushed into the Parquet reader so row
+    groups whose min/max stats miss the predicate are never decoded. Without an index
+    (see rebuild_index) partitions are pruned by directory name only.
+    """
+    dataset, expr = _dataset(root, athlete, start, end, bbox, awa_min, awa_max, abs_awa_min, abs_awa_max)
+    cols = list(columns) if columns else SCHEMA.names + ["athlete"]
+    if dataset is None:
+        return DATASET_SCHEMA.empty_table().select(cols)
+    if limit is not None:
+        return dataset.head(limit, columns=cols, filter=expr)
+    return dataset.to_table(columns=cols, filter=expr)
+
+def scan(root: str, *, columns: Optional[Iterable[str]] = None, batch_size: int = 65_536, **filters) -> Iterator[pa.RecordBatch]:
+    """Like query() (same filters), but streams record batches instead of building one table."""
+    dataset, expr = _dataset(root, **filters)
+    if dataset is None: return
+    cols = list(columns) if columns else SCHEMA.names + ["athlete"]
+    yield from dataset.to_batches(columns=cols, filter=expr, batch_size=batch_size)
+
+def awa_bins(batches: Iterable[pa.RecordBatch], bin_deg: float = 15.0, max_rows: Optional[int] = None) -> dict:
+    """Per |AWA| bin: sample count and mean speeds, plus boat speed relative to the overall mean.
+
+    speed_delta_m_s is the 'headwind penalty' proxy: how much slower (negative) or faster
+    the boat moves in that bin than across all matched samples. Batches (from scan()) are
+    folded into per-bin sums and counts a chunk at a time, so memory doesn't grow with the
+    match; past max_rows matched samples a ValueError is raised. Returns {sessions, count, bins}.
+    """
+    last_lo = (math.ceil(180.0 / bin_deg) - 1) * bin_deg   # |AWA| == 180 falls in the last bin
+    acc = {}   # bin_lo -> [count, speed sum, aws sum, aws count, tws sum, tws count]
+    sessions = set()
+
+    def fold(chunk: List[pa.RecordBatch]):
+        t = pa.Table.from_batches(chunk)
+        sessions.update(pc.unique(t["session_id"]).to_pylist())
+        bin_lo = pc.min_element_wise(pc.multiply(pc.floor(pc.divide(pc.abs(t["awa_deg"]), bin_deg)), bin_deg), last_lo)
+        t = pa.table({"bin_lo": bin_lo, "speed": t["speed_m_s"],
+                      "aws": t["apparent_wind_speed_ms"], "tws": t["wind_speed_10m_ms"]})
+        grouped = t.group_by("bin_lo").aggregate([
+            ("speed", "count"), ("speed", "sum"), ("aws", "sum"), ("aws", "count"), ("tws", "sum"), ("tws", "count"),
+        ])
+        for r in grouped.to_pylist():
+            a = acc.setdefault(r["bin_lo"], [0, 0.0, 0.0, 0, 0.0, 0])
+            a[0] += r["speed_count"]; a[1] += r["speed_sum"]
+            a[2] += r["aws_sum"] or 0.0; a[3] += r["aws_count"]
+            a[4] += r["tws_sum"] or 0.0; a[5] += r["tws_count"]
+
+    # archive files are small, so batches are too: group per ~1M rows, not per batch
+    chunk, chunk_rows, count = [], 0, 0
+    for b in batches:
+        b = b.filter(pc.and_(pc.is_valid(b["awa_deg"]), pc.is_valid(b["speed_m_s"])))
+        if b.num_rows == 0: continue
+        count += b.num_rows
+        if max_rows is not None and count > max_rows:
+            raise ValueError(f"More than {max_rows} samples match; narrow the filters.")
+        chunk.append(b); chunk_rows += b.num_rows
+        if chunk_rows >= AGG_CHUNK_ROWS:
+            fold(chunk); chunk, chunk_rows = [], 0
+    if chunk: fold(chunk)
+    if not count: return {"sessions": 0, "count": 0, "bins": []}
+
+    overall = sum(a[1] for a in acc.values()) / count
+    bins = []
+    for lo in sorted(acc):
+        n, speed, aws, n_aws, tws, n_tws = acc[lo]
+        bins.append({
+            "awa_lo_deg": lo, "awa_hi_deg": min(180.0, lo + bin_deg),
+            "count": n,
+            "mean_speed_m_s": speed / n,
+            "mean_apparent_wind_speed_ms": aws / n_aws if n_aws else None,
+            "mean_wind_speed_10m_ms": tws / n_tws if n_tws else None,
+            "speed_delta_m_s": speed / n - overall,
+        })
+    return {"sessions": len(sessions), "count": count, "bins": bins}
@@ -2,6 +2,7 @@ import math, bisect, logging, datetime
 from typing import Dict, List, Tuple
 import httpx
 from app.core.config import settings
+from app.services.admission import openmeteo, UpstreamUnavailable
 
 log = logging.getLogger("xboat-api")
 
@@ -31,7 +32,13 @@ def uv_speed(u: float, v: float):
     if u is None or v is None: return None
     return math.hypot(u, v)
 
-async def _era5(lat: float, lon: float, start_dt, end_dt) -> dict:
+async def _get_json(url: str, params: dict, timeout_s: float) -> dict:
+    async with httpx.AsyncClient(timeout=min(timeout_s, settings.OPENMETEO_TIMEOUT_S)) as client:
+        r = await client.get(url, params=params)
+    r.raise_for_status()
+    return r.json()
+
+async def _era5(lat: float, lon: float, start_dt, end_dt, deadline=None) -> dict:
     params = {
         "latitude": f"{lat:.6f}", "longitude": f"{lon:.6f}",
         "start_date": start_dt.date().isoformat(), "end_date": end_dt.date().isoformat(),
@@ -39,12 +46,9 @@ async def _era5(lat: float, lon: float, start_dt, end_dt) -> dict:
         "wind_speed_unit": "ms", "timeformat": "iso8601", "timezone": "UTC",
     }
     log.info(f"[Open-Meteo ERA5] {params}")
-    async with httpx.AsyncClient(timeout=settings.OPENMETEO_TIMEOUT_S) as client:
-        r = await client.get(OPEN_METEO_ARCHIVE, params=params)
-    r.raise_for_status()
-    return r.json()
+    return await openmeteo.call("era5", OPEN_METEO_ARCHIVE, params, _get_json, deadline)
 
-async def _forecast(lat: float, lon: float, start_dt, end_dt) -> dict:
+async def _forecast(lat: float, lon: float, start_dt, end_dt, deadline=None) -> dict:
     params = {
         "latitude": f"{lat:.6f}", "longitude": f"{lon:.6f}",
         "start_date": start_dt.date().isoformat(), "end_date": end_dt.date().isoformat(),
@@ -52,10 +56,7 @@ async def _forecast(lat: float, lon: float, start_dt, end_dt) -> dict:
         "windspeed_unit": "ms", "timeformat": "iso8601", "timezone": "UTC",
     }
     log.info(f"[Open-Meteo forecast] {params}")
-    async with httpx.AsyncClient(timeout=settings.OPENMETEO_TIMEOUT_S) as client:
-        r = await client.get(OPEN_METEO_FORECAST, params=params)
-    r.raise_for_status()
-    return r.json()
+    return await openmeteo.call("forecast", OPEN_METEO_FORECAST, params, _get_json, deadline)
 
 def _to_float(x):
     try:
@@ -88,20 +89,29 @@ def _build_uv(hourly: Dict):
 
 
 async def fetch_openmeteo_hourly_auto(lat: float, lon: float, start_dt, end_dt, pref: str="auto"):
+    # one time budget (OPENMETEO_TIMEOUT_S) covers both sources, waits included
+    deadline = openmeteo.deadline()
+    refused = []   # admission-control refusals: worth retrying later, unlike bad data
+
     async def try_source(fn, tag):
         try:
-            data = await fn(lat, lon, start_dt, end_dt)
+            data = await fn(lat, lon, start_dt, end_dt, deadline)
             t,u,v = _build_uv(data.get("hourly", {}))
             return (tag,t,u,v)
         except Exception as e:
+            if isinstance(e, UpstreamUnavailable): refused.append(e)
             log.warning(f"[{tag}] unusable hourly: {e}")
             return None
 
     if pref == "era5":
-        res = await try_source(_era5, "era5");  assert res, "ERA5 unusable"
+        res = await try_source(_era5, "era5")
+        if not res and refused: raise refused[-1]
+        assert res, "ERA5 unusable"
         return res
     if pref == "forecast":
-        res = await try_source(_forecast, "forecast"); assert res, "Forecast unusable"
+        res = await try_source(_forecast, "forecast")
+        if not res and refused: raise refused[-1]
+        assert res, "Forecast unusable"
         return res
 
     # auto: prefer ERA5, fallback forecast
@@ -109,6 +119,7 @@ async def fetch_openmeteo_hourly_auto(lat: float, lon: float, start_dt, end_dt,
     if res: return res
     res = await try_source(_forecast, "forecast")
     if res: return res
+    if refused: raise refused[-1]
     raise RuntimeError("Open-Meteo returned no usable hourly data.")
 
 def interp_uv_at(ts, times, u, v):
@@ -0,0 +1,163 @@
+import time, asyncio
+import httpx
+import pytest
+from app.services.admission import AdmissionControl, UpstreamUnavailable
+
+URL = "https://example.invalid/v1/archive"
+
+def make_ac(tmp_path, **kw) -> AdmissionControl:
+    opts = dict(state_path=str(tmp_path / "state.sqlite"), rate_per_s=0.0, burst=1, max_inflight=4,
+                acquire_timeout_s=1.0, upstream_timeout_s=2.0, failure_threshold=2, reset_s=0.2, stale_size=8)
+    opts.update(kw)
+    return AdmissionControl(**opts)
+
+class FakeFetch:
+    """Stands in for _get_json: counts calls and answers from a script of results/exceptions."""
+
+    def __init__(self, *results, hold: asyncio.Event = None):
+        self.results, self.hold, self.calls = list(results), hold, 0
+
+    async def __call__(self, url, params, timeout_s):
+        self.calls += 1
+        if self.hold is not None:
+            await self.hold.wait()
+        r = self.results.pop(0) if self.results else {"ok": True}
+        if isinstance(r, Exception): raise r
+        return r
+
+def http_error(code: int) -> httpx.HTTPStatusError:
+    req = httpx.Request("GET", URL)
+    return httpx.HTTPStatusError(f"{code}", request=req, response=httpx.Response(code, request=req))
+
+def state(ac, tag="era5") -> str:
+    return ac.breaker(tag).snapshot()["state"]
+
+def test_breaker_opens_then_single_probe_closes_it(tmp_path):
+    async def run():
+        ac = make_ac(tmp_path)
+        failing = FakeFetch(http_error(503), http_error(503))
+        for _ in range(2):
+            with pytest.raises(UpstreamUnavailable):
+                await ac.call("era5", URL, {"i": 1}, failing)
+        assert state(ac) == "open"
+
+        # open: refused without touching the upstream
+        idle = FakeFetch()
+        with pytest.raises(UpstreamUnavailable):
+            await ac.call("era5", URL, {"i": 1}, idle)
+        assert idle.calls == 0 and ac.counters["rejected_open"] == 1
+
+        await asyncio.sleep(0.25)
+        hold = asyncio.Event()
+        probe_fetch = FakeFetch(hold=hold)
+        probe = asyncio.create_task(ac.call("era5", URL, {"i": 1}, probe_fetch))
+        await asyncio.sleep(0.05)
+        assert state(ac) == "half_open" and probe_fetch.calls == 1
+        # only one probe at a time; everyone else is refused while it runs
+        with pytest.raises(UpstreamUnavailable):
+            await ac.call("era5", URL, {"i": 2}, idle)
+        assert idle.calls == 0
+        hold.set()
+        assert await probe == {"ok": True}
+        assert state(ac) == "closed"
+    asyncio.run(run())
+
+def test_failed_probe_reopens_breaker(tmp_path):
+    async def run():
+        ac = make_ac(tmp_path)
+        fetch = FakeFetch(http_error(500), http_error(500), httpx.ConnectError("refused"))
+        for _ in range(2):
+            with pytest.raises(UpstreamUnavailable):
+                await ac.call("era5", URL, {}, fetch)
+        await asyncio.sleep(0.25)
+        with pytest.raises(UpstreamUnavailable):
+            await ac.call("era5", URL, {}, fetch)
+        assert fetch.calls == 3 and state(ac) == "open"
+    asyncio.run(run())
+
+def test_cancelled_probe_releases_the_slot(tmp_path):
+    async def run():
+        ac = make_ac(tmp_path, failure_threshold=1)
+        with pytest.raises(UpstreamUnavailable):
+            await ac.call("era5", URL, {}, FakeFetch(http_error(502)))
+        await asyncio.sleep(0.25)
+        probe = asyncio.create_task(ac.call("era5", URL, {}, FakeFetch(hold=asyncio.Event())))
+        await asyncio.sleep(0.05)
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        # the next call becomes the probe at once instead of waiting out the lease
+        fetch = FakeFetch()
+        assert await ac.call("era5", URL, {}, fetch) == {"ok": True}
+        assert fetch.calls == 1 and state(ac) == "closed"
+    asyncio.run(run())
+
+def test_client_errors_do_not_trip_the_breaker(tmp_path):
+    async def run():
+        ac = make_ac(tmp_path)
+        fetch = FakeFetch(*(http_error(400) for _ in range(3)))
+        for _ in range(3):
+            with pytest.raises(httpx.HTTPStatusError):
+                await ac.call("era5", URL, {}, fetch)
+        assert state(ac) == "closed" and ac.counters["upstream_errors"] == 0
+    asyncio.run(run())
+
+def test_stale_response_served_while_open(tmp_path):
+    async def run():
+        ac = make_ac(tmp_path)
+        fetch = FakeFetch({"hourly": [1]}, http_error(503), http_error(503))
+        assert await ac.call("era5", URL, {"lat": 1}, fetch) == {"hourly": [1]}
+        for _ in range(2):
+            assert await ac.call("era5", URL, {"lat": 1}, fetch) == {"hourly": [1]}
+        assert state(ac) == "open"
+        assert await ac.call("era5", URL, {"lat": 1}, fetch) == {"hourly": [1]}
+        assert fetch.calls == 3 and ac.counters["stale_served"] == 3
+        # different parameters have nothing cached
+        with pytest.raises(UpstreamUnavailable):
+            await ac.call("era5", URL, {"lat": 2}, fetch)
+    asyncio.run(run())
+
+def test_token_bucket_refuses_past_the_deadline(tmp_path):
+    async def run():
+        ac = make_ac(tmp_path, rate_per_s=0.5, burst=1, acquire_timeout_s=0.2)
+        fetch = FakeFetch()
+        await ac.call("era5", URL, {"i": 1}, fetch)
+        t0 = time.monotonic()
+        with pytest.raises(UpstreamUnavailable):
+            await ac.call("era5", URL, {"i": 2}, fetch)
+        assert time.monotonic() - t0 < 1.0
+        # the caller's own deadline bounds the wait too
+        with pytest.raises(UpstreamUnavailable):
+            await ac.call("forecast", URL, {"i": 3}, fetch, deadline=time.monotonic() + 0.05)
+        assert fetch.calls == 1 and ac.counters["rejected_rate"] == 2
+        # a refusal is not an upstream failure
+        assert state(ac) == "closed" and state(ac, "forecast") == "closed"
+        assert ac._stats()["queue_depth"] == 0 and ac._stats()["waiting_for_token"] == 0
+    asyncio.run(run())
+
+def test_calls_waiting_for_a_token_count_as_queued(tmp_path):
+    async def run():
+        ac = make_ac(tmp_path, rate_per_s=0.5, burst=1, acquire_timeout_s=5.0, upstream_timeout_s=10.0)
+        fetch = FakeFetch()
+        tasks = [asyncio.create_task(ac.call("era5", URL, {"i": i}, fetch)) for i in range(4)]
+        await asyncio.sleep(0.2)
+        stats = ac._stats()
+        assert stats["queue_depth"] == 3 and stats["waiting_for_token"] == 3 and stats["inflight"] == 0
+        for t in tasks: t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        assert ac._stats()["queue_depth"] == 0 and ac._stats()["waiting_for_token"] == 0
+    asyncio.run(run())
+
+def test_limited_share_draws_from_its_own_bucket_too(tmp_path):
+    async def run():
+        ac = make_ac(tmp_path, rate_per_s=100.0, burst=10, acquire_timeout_s=0.2)
+        ac.limit_share(0.5, "backfill")
+        fetch = FakeFetch()
+        await ac.call("era5", URL, {"i": 1}, fetch)
+        with pytest.raises(UpstreamUnavailable):
+            await ac.call("era5", URL, {"i": 2}, fetch)
+        assert fetch.calls == 1 and ac.counters["rejected_rate"] == 1
+        # other processes without the share still have the shared budget
+        other = make_ac(tmp_path, rate_per_s=100.0, burst=10)
+        assert await other.call("era5", URL, {"i": 3}, fetch) == {"ok": True}
+    asyncio.run(run())
@@ -0,0 +1,104 @@
+import datetime as D
+import pytest
+from app.services import archive as A
+
+T0 = D.datetime(2025, 5, 1, 10, 0, tzinfo=D.timezone.utc)
+COLS = ["session_id", "awa_deg", "speed_m_s", "apparent_wind_speed_ms", "wind_speed_10m_ms"]
+
+def rows(awa, start=T0, lat=45.0, lon=6.0, speed=4.0):
+    return [{"timestamp": (start + D.timedelta(seconds=i)).isoformat(), "lat": lat + i * 1e-4, "lon": lon,
+             "speed_m_s": speed, "awa_deg": a, "apparent_wind_speed_ms": 5.0, "wind_speed_10m_ms": 3.0}
+            for i, a in enumerate(awa)]
+
+def write(root, athlete, session_id, awa, **kw):
+    A.write_session(str(root), athlete, session_id, A.to_table(rows(awa, **kw), session_id, "era5"))
+
+def ids(table):
+    return sorted(set(table.column("session_id").to_pylist()))
+
+def test_round_trip_with_filters(tmp_path):
+    write(tmp_path, "ann", "morning", [-170, -90, -30, 0, 30, 90, 170])
+    write(tmp_path, "ann", "evening", [45] * 5, start=T0 + D.timedelta(hours=8), lat=10.0)
+    write(tmp_path, "bob", "morning", [60] * 3)
+
+    everything = A.query(str(tmp_path))
+    assert everything.num_rows == 15
+    assert set(everything.column("athlete").to_pylist()) == {"ann", "bob"}
+
+    t = A.query(str(tmp_path), athlete="ann", start=T0 + D.timedelta(hours=1))
+    assert ids(t) == ["evening"] and t.num_rows == 5
+
+    t = A.query(str(tmp_path), bbox=(44.0, 5.0, 46.0, 7.0))
+    assert t.num_rows == 10 and "evening" not in ids(t)
+
+    # |AWA| keeps both tacks, the signed range only one
+    t = A.query(str(tmp_path), athlete="ann", start=T0, end=T0 + D.timedelta(minutes=1), abs_awa_min=80, abs_awa_max=175)
+    assert sorted(t.column("awa_deg").to_pylist()) == [-170, -90, 90, 170]
+    t = A.query(str(tmp_path), athlete="ann", start=T0, end=T0 + D.timedelta(minutes=1), awa_min=80)
+    assert sorted(t.column("awa_deg").to_pylist()) == [90, 170]
+
+    assert A.query(str(tmp_path), limit=4).num_rows == 4
+    assert A.query(str(tmp_path), athlete="nobody").num_rows == 0
+
+def test_awa_bins_edges(tmp_path):
+    write(tmp_path, "ann", "s1", [0, -14.9, 15, 179, -180, 180])
+    write(tmp_path, "ann", "s2", [90], start=T0 + D.timedelta(hours=2), speed=10.0)
+    result = A.awa_bins(A.scan(str(tmp_path), columns=COLS), bin_deg=15)
+    bins = {b["awa_lo_deg"]: b for b in result["bins"]}
+    assert result["sessions"] == 2 and result["count"] == 7
+    assert bins[0.0]["count"] == 2 and bins[15.0]["count"] == 1
+    # |AWA| == 180 belongs to the last bin, which ends at 180
+    assert bins[165.0]["count"] == 3 and bins[165.0]["awa_hi_deg"] == 180.0
+    assert bins[90.0]["speed_delta_m_s"] == pytest.approx(10.0 - (6 * 4.0 + 10.0) / 7)
+
+    # uneven bins: the last one is clamped to 180
+    result = A.awa_bins(A.scan(str(tmp_path), columns=COLS), bin_deg=50)
+    assert [(b["awa_lo_deg"], b["awa_hi_deg"]) for b in result["bins"]] == [(0, 50), (50, 100), (150, 180)]
+
+    with pytest.raises(ValueError):
+        A.awa_bins(A.scan(str(tmp_path), columns=COLS), max_rows=5)
+    assert A.awa_bins(A.scan(str(tmp_path), athlete="nobody", columns=COLS)) == {"sessions": 0, "count": 0, "bins": []}
+
+def test_claim_detects_duplicates(tmp_path):
+    root, end = str(tmp_path), T0 + D.timedelta(seconds=99)
+    assert A.claim_session(root, "ann", "run-gpx", T0, end) is None
+    # in flight: the same activity from another format waits its turn, even with overwrite
+    assert A.claim_session(root, "ann", "run-tcx", T0, end, overwrite=True) == "run-gpx"
+    write(tmp_path, "ann", "run-gpx", [30] * 100)
+
+    assert A.claim_session(root, "ann", "run-tcx", T0 + D.timedelta(seconds=10), end) == "run-gpx"
+    # a different athlete, or a session that barely overlaps, is not a duplicate
+    assert A.claim_session(root, "bob", "run-tcx", T0, end) is None
+    assert A.claim_session(root, "ann", "later", end - D.timedelta(seconds=5), end + D.timedelta(hours=1)) is None
+
+def test_failed_overwrite_keeps_the_stored_session(tmp_path):
+    root, end = str(tmp_path), T0 + D.timedelta(seconds=99)
+    write(tmp_path, "ann", "run-gpx", [30] * 100)
+
+    assert A.claim_session(root, "ann", "run-gpx", T0, end, overwrite=True) is None
+    A.release_claim(root, "ann", "run-gpx")
+    assert A.query(root).num_rows == 100
+
+    assert A.claim_session(root, "ann", "run-tcx", T0, end, overwrite=True) is None
+    A.release_claim(root, "ann", "run-tcx")
+    assert ids(A.query(root)) == ["run-gpx"]
+
+    # a successful overwrite replaces the other format only once its own file is in place
+    assert A.claim_session(root, "ann", "run-tcx", T0, end, overwrite=True) is None
+    assert ids(A.query(root)) == ["run-gpx"]
+    A.write_session(root, "ann", "run-tcx", A.to_table(rows([40] * 100), "run-tcx", "era5"), replace_overlapping=True)
+    assert ids(A.query(root)) == ["run-tcx"] and A.query(root).num_rows == 100
+    assert not A.session_exists(root, "ann", "run-gpx")
+
+def test_rebuild_index(tmp_path):
+    write(tmp_path, "ann", "s1", [30] * 3)
+    write(tmp_path, "ann", "s2", [150] * 2, start=T0 + D.timedelta(days=1))
+    (tmp_path / A.INDEX_FILE).unlink()
+
+    # without an index the partitions are still scanned
+    assert A.query(str(tmp_path), abs_awa_min=100).num_rows == 2
+    assert A.rebuild_index(str(tmp_path)) == 2
+    assert A._indexed_files(str(tmp_path), "ann", None, None, None, None, None, abs_awa_min=100) == [
+        str(tmp_path / "athlete=ann" / "date=2025-05-02" / "s2.parquet")]
+    assert A.query(str(tmp_path), abs_awa_min=100).num_rows == 2
+    assert A.query(str(tmp_path)).num_rows == 5